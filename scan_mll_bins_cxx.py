@@ -1,11 +1,28 @@
 #!/usr/bin/env python3
-import re
+import contextlib
+import hashlib
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
 import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 import sys
 
+try:
+    # Third-party drop-in for re with better protection against runaway backtracking
+    import regex as re
+except ImportError:
+    import re
+
 BASE_DIR = Path(__file__).resolve().parent
 
+logger = logging.getLogger(__name__)
+
 GENERATE_EVENTS = BASE_DIR / "bin" / "generate_events"
 
 # ---- run_card configuration ----
@@ -21,6 +38,9 @@ OUTPUT_FILE     = BASE_DIR / "xsec_vs_mll_cxx.txt"
 LOG_DIR = BASE_DIR / "logs"
 LOG_DIR.mkdir(exist_ok=True)
 
+# Process directory MG actually runs in; a worker's sandbox copy when run in parallel
+SANDBOX_DIR = BASE_DIR
+
 # --- user configuration ------------------------------------------------------
 
 # List of dilepton mass bins [GeV]
@@ -78,6 +98,23 @@ PARAM_MAX = "mmllmax"
 # List of cxx values to scan
 CXX_VALUES = [-100, -70, -35, -20, -10, -5, -1, 1, 5, 10, 20, 35, 70, 100]
 
+# Number of MadGraph runs executed in parallel. Each worker runs inside its own
+# copy of the process directory, so the cards of one job never clobber another's.
+# Keep this small: every copy includes the compiled SubProcesses/ tree, and each
+# generate_events uses several cores by itself.
+N_WORKERS = 4
+
+# Sub-directories (relative to the process dir) that the worker copies share through
+# a symlink instead of copying them. Only list trees MadGraph never writes to during
+# a run: SubProcesses, Source and lib are recompiled per run, and bin/ must be a real
+# copy because generate_events locates its process dir through its own path.
+SHARED_SUBDIRS = ["lib/Pdfdata"]
+
+# Resume an interrupted scan: if OUTPUT_FILE was written by a scan with the same cards
+# (see HEADER), skip every job that already has a row there or a log in logs/ from a run
+# that finished. Delete OUTPUT_FILE or set this to False to rerun everything.
+RESUME = True
+
 # Name/comment used for this Wilson coefficient in the param_card
 if len(sys.argv) < 2:
     print("Usage: nohup python3 scan_mll_bins_cxx.py <cxx>")
@@ -87,69 +124,176 @@ CXX_LABEL = sys.argv[1]
 
 # -----------------------------------------------------------------------------
 
-
-def update_run_card(mmin, mmax):
+# Regexes used to edit the cards, compiled once.
+# A card number, e.g. "15.0" or "-1.000000e+02". Where atomic groups are available
+# (regex module, or re from Python 3.11) the engine never backtracks into it.
+_NUMBER = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+if re.__name__ == "regex" or sys.version_info >= (3, 11):
+    _NUMBER = rf"(?>{_NUMBER})"
+# run_card lines look like: "  15.0 = mmll  ! comment"
+_RE_PARAMS = re.compile(
+    rf"^\s*{_NUMBER}(\s*=\s*(?P<name>{PARAM_MIN}|{PARAM_MAX})\b)", re.MULTILINE
+)
+# param_card lines look like: "  <int>  <number>   # cxx"
+_RE_CXX    = re.compile(rf"^(\s*\d+\s+){_NUMBER}(\s+#\s*{CXX_LABEL}\b)", re.MULTILINE)
+# me5_configuration.txt line setting the number of cores MG uses, possibly commented out
+_RE_NB_CORE = re.compile(r"^#?[ \t]*nb_core[ \t]*=.*$", re.MULTILINE)
+# generate_events summary line: "  Cross-section :   1.234e+02 +- 5.67e-01 pb"
+_XSEC_RE = re.compile(rb"Cross-section[ \t]*:[ \t]*(\S+)[ \t]*\+-[ \t]*(\S+)[ \t]+(\S+)")
+# Size of the end of the log searched first for the summary line [bytes]
+_LOG_TAIL_BYTES = 65536
+
+# generate_events process currently run by this (worker) process, if any
+_MG_PROC = None
+
+
+def load_run_card_template():
 	"""
-	Read the template run_card, replace mmll and mmllmax values, and write run_card.dat
+	Read the template run_card and turn the mmll and mmllmax values into {MMLL} and
+	{MMLLMAX} placeholders, so that each bin only needs a str.format call.
 	"""
-	text = TEMPLATE_CARD.read_text()
+	# Escape any literal braces of the card before adding the placeholders
+	text = TEMPLATE_CARD.read_text().replace("{", "{{").replace("}", "}}")
+
+	# Replace the number on the lines that define PARAM_MIN and PARAM_MAX, in one pass
+	placeholders = {PARAM_MIN: "{MMLL}", PARAM_MAX: "{MMLLMAX}"}
+	found = set()
 
-	# Regex: replace the number on the line that defines PARAM_MIN and PARAM_MAX
-	# Lines look like: "  15.0 = mmll  ! comment"
-	pattern_min = rf"^\s*[-+]?[\d.eE+-]+(\s*=\s*{PARAM_MIN}\b)"
-	pattern_max = rf"^\s*[-+]?[\d.eE+-]+(\s*=\s*{PARAM_MAX}\b)"
+	def to_placeholder(m):
+		found.add(m.group("name"))
+		return f" {placeholders[m.group('name')]}{m.group(1)}"
 
-	text, nmin = re.subn(pattern_min, f" {mmin:.6g}\\1", text, flags=re.MULTILINE)
-	text, nmax = re.subn(pattern_max, f" {mmax:.6g}\\1", text, flags=re.MULTILINE)
+	text = _RE_PARAMS.sub(to_placeholder, text)
 
-	if nmin == 0 or nmax == 0:
+	if found != placeholders.keys():
 		raise RuntimeError(
 			f"Could not find {PARAM_MIN} or {PARAM_MAX} lines in {TEMPLATE_CARD}."
 		)
 
-	RUN_CARD.write_text(text)
-	print(f"  -> Updated run_card.dat: {PARAM_MIN}={mmin}, {PARAM_MAX}={mmax}")
+	return text
 
 
-def update_param_card(cxx_value):
+_TEMPLATE_RUN = load_run_card_template()
+
+
+def update_run_card(mmin, mmax):
 	"""
-	Read the template param_card and replace the value of the cxx Wilson coefficient, then write Cards/param_card.dat.
+	Fill the mmll and mmllmax values into the template run_card and write run_card.dat
 	"""
-	text = PARAM_CARD_TEMPLATE.read_text()
+	RUN_CARD.write_text(_TEMPLATE_RUN.format(MMLL=f"{mmin:.6g}", MMLLMAX=f"{mmax:.6g}"))
 
-	# Pattern: match a line like:
-	#   <int>  <number>   # cxx
-	# and replace only the <number>
-	pattern_cxx = rf"^(\s*\d+\s+)[-+]?[\d.eE+-]+(\s+#\s*{CXX_LABEL}\b)"
 
-	new_text, n = re.subn(
-		pattern_cxx,
-		lambda m: f"{m.group(1)}{cxx_value:.6e}{m.group(2)}",
-		text,
-		flags=re.MULTILINE,
-	)
+def load_param_card_template():
+	"""
+	Read the template param_card and turn the value of the cxx Wilson coefficient into
+	a {CXX} placeholder for str.format.
+	"""
+	# Escape any literal braces of the card before adding the placeholder
+	text = PARAM_CARD_TEMPLATE.read_text().replace("{", "{{").replace("}", "}}")
+
+	# Replace only the <number> on the "<int>  <number>   # cxx" line
+	text, n = _RE_CXX.subn(r"\1{CXX}\2", text)
 
 	if n == 0:
 		raise RuntimeError(
 			f"Could not find a line with '# {CXX_LABEL}' in {PARAM_CARD_TEMPLATE}"
 		)
 
-	PARAM_CARD.write_text(new_text)
-	print(f"  -> Updated param_card.dat: {CXX_LABEL} = {cxx_value}")
+	return text
+
+
+_TEMPLATE_PARAM = load_param_card_template()
+
+# Results are only resumed from an OUTPUT_FILE whose header, and from logs whose last
+# line, carry the tag of the current cards and CXX_LABEL, so editing a template or
+# switching the label reruns everything.
+_CARDS_SHA1 = hashlib.sha1((_TEMPLATE_RUN + _TEMPLATE_PARAM).encode()).hexdigest()[:12]
+_SCAN_TAG = f"[cxx={CXX_LABEL} cards={_CARDS_SHA1}]"
+HEADER = f"# mll_min[GeV]  mll_max[GeV]   cxx    xsec    err    unit  {_SCAN_TAG}\n"
+# Appended to the log of a run that exited 0 with a cross section
+_LOG_DONE = f"# run finished {_SCAN_TAG}\n".encode()
+
+
+def update_param_card(cxx_value):
+	"""
+	Fill the value of the cxx Wilson coefficient into the template param_card, then write Cards/param_card.dat.
+	"""
+	PARAM_CARD.write_text(_TEMPLATE_PARAM.format(CXX=f"{cxx_value:.6e}"))
+
+
+def cross_section_from_match(match):
+	"""
+	Convert a _XSEC_RE match into (xsec, err, unit).
+	"""
+	try:
+		xsec = float(match.group(1))
+		err = float(match.group(2))
+		unit = match.group(3).decode()
+	except ValueError as e:
+		line = match.group(0).decode(errors="replace")
+		raise RuntimeError(f"Could not parse cross section from line:\n{line}") from e
+
+	return xsec, err, unit
+
+
+def make_run_name(mmin, mmax, cxx):
+	"""
+	Unique MG run name for one (mass bin, cxx) point.
+	"""
+	cxx_tag = str(cxx).replace(".", "p").replace("-", "m")
+	return f"mll_{int(mmin)}_{int(mmax)}_cxx_{cxx_tag}"
+
+
+def log_path_for(run_name):
+	"""
+	Log file of a run.
+	"""
+	return LOG_DIR / f"{run_name}.log"
 
 
 def run_madgraph(run_name):
 	"""
-	Call ./bin/generate_events for a given run_name and capture stdout/stderr into logs/<run_name>.log
+	Call ./bin/generate_events for a given run_name, copy stdout/stderr into logs/<run_name>.log
+	and pick up the cross section from the output while it streams by.
+
+	Returns (log_path, xsec, err, unit).
 	"""
 	cmd = [str(GENERATE_EVENTS), run_name, "-f"]
-	print("  -> Running:", " ".join(cmd))
+	log_path = log_path_for(run_name)
+	match = None
+	# close_fds=False skips closing every descriptor in the child (Python's own
+	# descriptors are non-inheritable anyway). MG gets its own session, so a
+	# Ctrl-C aimed at the scan does not reach it half-way through writing files;
+	# instead we take its whole process group down if we are interrupted or
+	# killed (see install_signal_handlers).
+	global _MG_PROC
+	with log_path.open("wb") as log, subprocess.Popen(
+		cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+		close_fds=False, start_new_session=True,
+	) as proc:
+		_MG_PROC = proc
+		try:
+			for line in proc.stdout:
+				log.write(line)
+				if b"Cross-section" in line:
+					match = _XSEC_RE.search(line) or match
+		except BaseException:
+			with contextlib.suppress(ProcessLookupError):
+				os.killpg(proc.pid, signal.SIGTERM)
+			raise
+		finally:
+			_MG_PROC = None
+
+	if proc.returncode != 0:
+		raise subprocess.CalledProcessError(proc.returncode, cmd)
+	if match is None:
+		raise RuntimeError(f"Could not find 'Cross-section :' line in {log_path}")
 
-	log_path = LOG_DIR / f"{run_name}.log"
-	with log_path.open("w") as log:
-		subprocess.run(cmd, check=True, stdout=log, stderr=subprocess.STDOUT)
+	xsec, err, unit = cross_section_from_match(match)
+	with log_path.open("ab") as log:
+		log.write(_LOG_DONE)
 
-	return log_path
+	return log_path, xsec, err, unit
 
 
 def parse_cross_section(log_path):
@@ -158,68 +302,336 @@ def parse_cross_section(log_path):
 
 	We look for a line like:
 	  ' Cross-section :   6.594e+02  +-  3.011e+00 pb'
+	MadGraph prints it near the end, so only the last _LOG_TAIL_BYTES of the log are
+	searched (with bytes.rfind, the last such line wins), falling back to the whole
+	file if it is not found there.
 	"""
 	if not log_path.exists():
 		raise FileNotFoundError(f"Log file not found: {log_path}")
-	
-	xsec = None
-	err = None
-	unit = None
-
-	with log_path.open() as f:
-		for line in f:
-			# Typical line: "  Cross-section :   1.234e+02 +- 5.67e-01 pb"
-			if "Cross-section :" in line:
-				parts = line.split()
-				# Example indices: ["Cross-section",":","1.234e+02","+-","5.67e-01","pb"]
-				try:
-					xsec = float(parts[2])
-					err = float(parts[4])
-					unit = parts[5]
-				except Exception as e:
-					raise RuntimeError(f"Could not parse cross section from line:\n{line}") from e
-				break
-
-	if xsec is None:
+
+	with log_path.open("rb") as f:
+		size = os.fstat(f.fileno()).st_size
+		f.seek(max(0, size - _LOG_TAIL_BYTES))
+		match = last_cross_section(f.read())
+		if match is None and size > _LOG_TAIL_BYTES:
+			f.seek(0)
+			match = last_cross_section(f.read())
+
+	if match is None:
 		raise RuntimeError(f"Could not find 'Cross-section :' line in {log_path}")
 
-	return xsec, err, unit
+	return cross_section_from_match(match)
 
 
-def main():
-	# Write header
-	with OUTPUT_FILE.open("w") as out:
-		out.write("# mll_min[GeV]  mll_max[GeV]   cxx    xsec    err    unit\n")
+def last_cross_section(data):
+	"""
+	_XSEC_RE match of the last summary line in data, or None. Walks back over the
+	occurrences of "Cross-section" with bytes.rfind; lines that only mention it are
+	skipped, as in run_madgraph.
+	"""
+	end = len(data)
+	while True:
+		idx = data.rfind(b"Cross-section", 0, end)
+		if idx < 0:
+			return None
+		eol = data.find(b"\n", idx)
+		match = _XSEC_RE.match(data, idx, eol if eol >= 0 else len(data))
+		if match is not None:
+			return match
+		end = idx
 
-	for i, (mmin, mmax) in enumerate(MASS_BINS, start=1):
-		for cxx in CXX_VALUES:
-			print(f"\n=== Bin {i}: {mmin} - {mmax} GeV, cxx = {cxx} ===")
 
-			# 1) update run_card.dat
-			update_run_card(mmin, mmax)
+def _raise_system_exit(signum, frame):
+	raise SystemExit(128 + signum)
 
-			# 2) update param_card for this cxx
-			update_param_card(cxx)
 
-			# 3) choose a unique run name
-			cxx_tag = str(cxx).replace(".", "p").replace("-", "m")
-			run_name = f"mll_{int(mmin)}_{int(mmax)}_cxx_{cxx_tag}"
+def _kill_madgraph_and_exit(signum, frame):
+	if _MG_PROC is not None:
+		with contextlib.suppress(ProcessLookupError):
+			os.killpg(_MG_PROC.pid, signal.SIGTERM)
+	os._exit(128 + signum)
 
-			# 4) run MG
-			log_path = run_madgraph(run_name)
 
-			# 5) parse cross section
-			xsec, err, unit = parse_cross_section(log_path)
-			print(f"  -> Cross-section: {xsec} +- {err} {unit}")
+def install_signal_handlers(handler):
+	"""
+	Install handler for SIGTERM and SIGHUP (unless ignored, e.g. under nohup). MG runs in
+	its own session, so these signals only reach it through the handlers: the main process
+	raises SystemExit and terminates the workers, the workers kill their MG process group.
+	"""
+	for signum in (signal.SIGTERM, signal.SIGHUP):
+		if signal.getsignal(signum) is not signal.SIG_IGN:
+			signal.signal(signum, handler)
 
-			# 6) append to output text file
-			with OUTPUT_FILE.open("a") as out:
-				out.write(
-					f"{mmin:10.3f} {mmax:10.3f} {cxx:8.3f} "
-					f"{xsec:12.6e} {err:12.6e} {unit}\n"
-				)
 
-	print("\nAll done. Results in", OUTPUT_FILE)
+def setup_sandbox(work_dir):
+	"""
+	Give this worker process its own fresh copy of the process directory
+	(<work_dir>/worker_<pid>) and point SANDBOX_DIR, RUN_CARD, PARAM_CARD and
+	GENERATE_EVENTS at it.
+	The copy is made once per worker and reused for all of its jobs.
+	"""
+	global SANDBOX_DIR, RUN_CARD, PARAM_CARD, GENERATE_EVENTS
+
+	skip = shutil.ignore_patterns("Events", "logs")
+	shared = {BASE_DIR / subdir for subdir in SHARED_SUBDIRS}
+
+	def ignore(src, names):
+		return set(skip(src, names)) | {n for n in names if Path(src, n) in shared}
+
+	SANDBOX_DIR = sandbox = work_dir / f"worker_{os.getpid()}"
+	shutil.copytree(BASE_DIR, sandbox, symlinks=True, ignore=ignore)
+	(sandbox / "Events").mkdir()
+	for subdir in SHARED_SUBDIRS:
+		if (BASE_DIR / subdir).exists():
+			(sandbox / subdir).symlink_to(BASE_DIR / subdir)
+
+	RUN_CARD        = sandbox / "Cards" / "run_card.dat"
+	PARAM_CARD      = sandbox / "Cards" / "param_card.dat"
+	GENERATE_EVENTS = sandbox / "bin" / "generate_events"
+
+
+def pin_worker(worker_id):
+	"""
+	Restrict this worker, and the MG processes it starts, to its own share of the CPUs, and
+	make MG (nb_core in the sandbox's me5_configuration.txt) and OpenMP use only that many.
+	Without this every generate_events runs on all cores and N_WORKERS runs oversubscribe them.
+	"""
+	if hasattr(os, "sched_getaffinity"):
+		cpus = sorted(os.sched_getaffinity(0))
+	else:
+		cpus = list(range(os.cpu_count()))
+	if len(cpus) >= N_WORKERS:
+		# Contiguous shares; the first len(cpus) % N_WORKERS workers get one core more
+		per_worker, extra = divmod(len(cpus), N_WORKERS)
+		slot = worker_id % N_WORKERS
+		start = slot * per_worker + min(slot, extra)
+		mine = cpus[start:start + per_worker + (slot < extra)]
+	else:
+		mine = [cpus[worker_id % len(cpus)]]
+
+	# The affinity mask and the environment are inherited by generate_events
+	if hasattr(os, "sched_setaffinity"):
+		os.sched_setaffinity(0, mine)
+	os.environ["OMP_NUM_THREADS"] = str(len(mine))
+
+	config = SANDBOX_DIR / "Cards" / "me5_configuration.txt"
+	if config.exists():
+		# Rewrite every nb_core line: a later active one would override the first
+		text, n = _RE_NB_CORE.subn(f"nb_core = {len(mine)}", config.read_text())
+		if n == 0:
+			text += f"\nnb_core = {len(mine)}\n"
+		config.write_text(text)
+
+
+def init_worker(work_dir, log_queue, worker_counter):
+	"""
+	Pool initializer: send this worker's log records through log_queue to the main process,
+	kill the running MG on SIGTERM/SIGHUP, set up the worker's sandbox and pin it to its CPUs.
+	worker_counter is a shared multiprocessing.Value handing out worker ids 0, 1, ...
+	"""
+	root = logging.getLogger()
+	root.handlers[:] = [QueueHandler(log_queue)]
+	root.setLevel(logging.INFO)
+
+	install_signal_handlers(_kill_madgraph_and_exit)
+	setup_sandbox(work_dir)
+
+	with worker_counter.get_lock():
+		worker_id = worker_counter.value
+		worker_counter.value += 1
+	pin_worker(worker_id)
+
+
+def collect_events(run_name):
+	"""
+	Move Events/<run_name> from this worker's sandbox into Events/ of the process directory,
+	replacing an older run of the same name (as generate_events -f would).
+	"""
+	src = SANDBOX_DIR / "Events" / run_name
+	dst = BASE_DIR / "Events" / run_name
+	if src == dst or not src.exists():
+		return
+
+	if dst.exists():
+		shutil.rmtree(dst)
+	dst.parent.mkdir(exist_ok=True)
+	shutil.move(str(src), str(dst))
+
+
+def run_bin(i, mmin, mmax, cxx):
+	"""
+	Run MadGraph for one (mass bin, cxx) point inside this worker's sandbox and
+	return (mmin, mmax, cxx, xsec, err, unit).
+	"""
+	# 1) update run_card.dat
+	update_run_card(mmin, mmax)
+
+	# 2) update param_card for this cxx
+	update_param_card(cxx)
+
+	# 3) choose a unique run name
+	run_name = make_run_name(mmin, mmax, cxx)
+
+	# 4) run MG and pick up the cross section from its output
+	logger.info(
+		"\n=== Bin %s: %s - %s GeV, cxx = %s ===\n"
+		"  -> Updated run_card.dat: %s=%s, %s=%s\n"
+		"  -> Updated param_card.dat: %s = %s\n"
+		"  -> Running: %s %s -f",
+		i, mmin, mmax, cxx, PARAM_MIN, mmin, PARAM_MAX, mmax, CXX_LABEL, cxx,
+		GENERATE_EVENTS, run_name,
+	)
+	try:
+		_, xsec, err, unit = run_madgraph(run_name)
+	finally:
+		collect_events(run_name)
+	logger.info("  -> Cross-section (%s): %s +- %s %s", run_name, xsec, err, unit)
+
+	return mmin, mmax, cxx, xsec, err, unit
+
+
+def job_key(mmin, mmax, cxx):
+	"""
+	Key of a job in the dict of finished rows: its leading columns as they appear in OUTPUT_FILE.
+	"""
+	return f"{mmin:.3f} {mmax:.3f} {cxx:.3f}"
+
+
+def format_row(mmin, mmax, cxx, xsec, err, unit):
+	"""
+	One line of OUTPUT_FILE.
+	"""
+	return (
+		f"{mmin:10.3f} {mmax:10.3f} {cxx:8.3f} "
+		f"{xsec:12.6e} {err:12.6e} {unit}\n"
+	)
+
+
+def load_done_rows():
+	"""
+	Rows of an earlier run of this scan found in OUTPUT_FILE, keyed by job_key. None if
+	OUTPUT_FILE does not exist or starts with another header; a last row cut off by a
+	crash is dropped.
+	"""
+	if not OUTPUT_FILE.exists():
+		return None
+	text = OUTPUT_FILE.read_text()
+	if not text.startswith(HEADER):
+		return None
+
+	rows = {}
+	for line in text[len(HEADER):].splitlines(keepends=True):
+		parts = line.split()
+		if line.endswith("\n") and len(parts) == 6:
+			rows[" ".join(parts[:3])] = line
+	return rows
+
+
+def row_from_log(mmin, mmax, cxx):
+	"""
+	Row of a (mass bin, cxx) point whose MG run finished before the scan was interrupted,
+	read back from its log with parse_cross_section. None unless the log ends with
+	_LOG_DONE, i.e. the run exited 0 with these cards.
+	"""
+	log_path = log_path_for(make_run_name(mmin, mmax, cxx))
+	try:
+		with log_path.open("rb") as f:
+			f.seek(max(0, os.fstat(f.fileno()).st_size - len(_LOG_DONE)))
+			if f.read() != _LOG_DONE:
+				return None
+		xsec, err, unit = parse_cross_section(log_path)
+	except (FileNotFoundError, RuntimeError):
+		return None
+	return format_row(mmin, mmax, cxx, xsec, err, unit)
+
+
+def write_output(jobs, rows):
+	"""
+	Rewrite OUTPUT_FILE with the header and the finished rows in job order. The new file
+	is written next to it and renamed over it, so an interruption never leaves it half-written.
+	"""
+	tmp = OUTPUT_FILE.with_name(OUTPUT_FILE.name + ".tmp")
+	with tmp.open("w") as out:
+		out.write(HEADER)
+		for _, mmin, mmax, cxx in jobs:
+			row = rows.get(job_key(mmin, mmax, cxx))
+			if row is not None:
+				out.write(row)
+	os.replace(tmp, OUTPUT_FILE)
+
+
+def main():
+	install_signal_handlers(_raise_system_exit)
+
+	logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+	logger.info("Process dir:         %s", BASE_DIR)
+	logger.info("Run card template:   %s", TEMPLATE_CARD)
+	logger.info("Param card template: %s", PARAM_CARD_TEMPLATE)
+	logger.info("generate_events:     %s", GENERATE_EVENTS)
+	logger.info("Logs:                %s", LOG_DIR)
+	logger.info("Output:              %s", OUTPUT_FILE)
+
+	jobs = [
+		(i, mmin, mmax, cxx)
+		for i, (mmin, mmax) in enumerate(MASS_BINS, start=1)
+		for cxx in CXX_VALUES
+	]
+	# Pick up what an interrupted run of this scan already finished: rows in OUTPUT_FILE,
+	# then MG runs that completed but whose row was never collected
+	rows = load_done_rows() if RESUME else None
+	if rows is None:
+		rows = {}
+	else:
+		for _, mmin, mmax, cxx in jobs:
+			key = job_key(mmin, mmax, cxx)
+			if key not in rows:
+				row = row_from_log(mmin, mmax, cxx)
+				if row is not None:
+					rows[key] = row
+	pending = [job for job in jobs if job_key(*job[1:]) not in rows]
+	logger.info("%d of %d jobs already done", len(jobs) - len(pending), len(jobs))
+	write_output(jobs, rows)
+
+	# The worker sandboxes of this run live in a fresh directory next to the process dir,
+	# which is removed again at the end: no run ever picks up a stale copy.
+	work_dir = Path(tempfile.mkdtemp(prefix=f"{BASE_DIR.name}_work_", dir=BASE_DIR.parent))
+
+	# Workers send their log records through a queue; only the main process writes them,
+	# so the status of parallel jobs never interleaves on stdout.
+	log_queue = multiprocessing.Queue()
+	worker_counter = multiprocessing.Value("i", 0)
+	listener = QueueListener(log_queue, *logging.getLogger().handlers)
+	listener.start()
+	try:
+		# The output file stays open for the whole scan; line buffering pushes every
+		# row to disk as soon as it is written, so a crash does not lose finished jobs.
+		# New rows are appended after the ones kept from an earlier run.
+		with OUTPUT_FILE.open("a", buffering=1) as out, ProcessPoolExecutor(
+			max_workers=N_WORKERS, initializer=init_worker,
+			initargs=(work_dir, log_queue, worker_counter),
+		) as pool:
+			futures = [pool.submit(run_bin, *job) for job in pending]
+			try:
+				# Collect in submission order, so that rows come out sorted
+				for future in futures:
+					result = future.result()
+					row = format_row(*result)
+					rows[job_key(*result[:3])] = row
+					out.write(row)
+			except BaseException:
+				# Stop the workers (they kill their running MG process group on SIGTERM);
+				# the broken pool then fails all jobs that did not start yet.
+				for worker in multiprocessing.active_children():
+					worker.terminate()
+				raise
+
+		# Put the rows kept from an earlier run and the new ones back into bin order
+		write_output(jobs, rows)
+	finally:
+		listener.stop()
+		shutil.rmtree(work_dir, ignore_errors=True)
+
+	logger.info("\nAll done. Results in %s", OUTPUT_FILE)
 
 
 if __name__ == "__main__":